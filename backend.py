@@ -7,69 +7,301 @@ Multi-agent video generation preprocessing pipeline:
 Supports:
   - 5-second videos: Single fragment generation
   - 10-second videos: Two fragments with continuation prompts
+
+Runs on Quart (async Flask API) with a shared AsyncOpenAI client, so concurrent
+/run requests interleave their Grok API calls on one event loop instead of
+blocking a worker per request.
 """
 
+from __future__ import annotations
+
 import os
-import json
-import base64
+import atexit
+import asyncio
+import functools
+import hashlib
+import logging
+import logging.handlers
+import queue
+import uuid
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
-from openai import OpenAI
-from dotenv import load_dotenv
+from typing import TYPE_CHECKING, Awaitable, Callable
+import msgspec
+import orjson
+from quart import Quart, request, jsonify, send_from_directory
+from quart_cors import cors
+from werkzeug.exceptions import RequestEntityTooLarge
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from cachetools import TTLCache
+
+# pybase64 (SIMD-accelerated, same API) when installed, stdlib base64 otherwise
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
 
 # Import all configuration from config.py
 import config
 
-# Load environment variables from .env file
-load_dotenv()
+# openai/httpx are imported lazily in get_client() to keep cold start fast
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
-app = Flask(__name__)
-CORS(app)
+app = cors(Quart(__name__))
+app.config["MAX_CONTENT_LENGTH"] = config.MAX_REQUEST_SIZE_BYTES
 
 # Project root directory
 PROJECT_ROOT = Path(__file__).parent
 
+# xAI API key, read once at import (None if unset; config already loaded .env)
+_API_KEY = os.environ.get("XAI_API_KEY")
+
 # =============================================================================
-# PROMPT LOADING (Fresh from files on each request)
+# LOGGING (queued; a listener thread formats and writes records)
 # =============================================================================
 
-def load_prompt(filepath: str) -> str:
-    """Load a system prompt from file (fresh read, no caching)."""
-    prompt_path = PROJECT_ROOT / filepath
-    with open(prompt_path, "r", encoding="utf-8") as f:
-        return f.read().strip()
+logger = logging.getLogger("grokvalidator")
+logger.setLevel(logging.INFO if config.LOG_API_CALLS else logging.WARNING)
+logger.propagate = False
 
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush queued records on shutdown
+
+# =============================================================================
+# PROMPT LOADING (Cached by config.load_prompt, reloaded when the file changes)
+# =============================================================================
 
 def get_agent1_prompt() -> str:
     """Load Agent 1 (Image Analyzer) system prompt."""
-    return load_prompt(config.AGENT1_PROMPT_FILE)
+    return config.load_prompt(config.AGENT1_PROMPT_FILE)
 
 
 def get_agent2_prompt() -> str:
     """Load Agent 2 (Neutral Enhancer) system prompt."""
-    return load_prompt(config.AGENT2_PROMPT_FILE)
+    return config.load_prompt(config.AGENT2_PROMPT_FILE)
 
 
 def get_agent3_prompt() -> str:
     """Load Agent 3 (Adult Enhancer) system prompt."""
-    return load_prompt(config.AGENT3_PROMPT_FILE)
+    return config.load_prompt(config.AGENT3_PROMPT_FILE)
+
+
+def prefetch_enhancer_prompts() -> None:
+    """Load Agent 2/3 prompts into the prompt cache (run in a thread during Agent 1)."""
+    get_agent2_prompt()
+    get_agent3_prompt()
+
+
+@functools.lru_cache(maxsize=8)
+def system_message(system_prompt: str) -> dict:
+    """System message for a prompt, built once per prompt text (shared, never mutated)."""
+    return {"role": "system", "content": system_prompt}
+
+
+# Agent 1 results that hit the safety gate: Agent 1 cache key -> (agent1_result, agent1_details)
+blocked_cache = TTLCache(
+    maxsize=config.BLOCK_CACHE_MAX_ENTRIES,
+    ttl=config.BLOCK_CACHE_TTL_SECONDS
+)
+
+# Recent run results for /result/<request_id>, stored as serialized JSON bytes
+# (per worker, only touched from the event loop thread; also written to the disk
+# cache when enabled so any worker can serve /result)
+results_cache = TTLCache(
+    maxsize=config.RESULT_CACHE_MAX_ENTRIES,
+    ttl=config.RESULT_CACHE_TTL_SECONDS
+)
+
+# Cache of agent responses for repeated inputs: key -> (parsed_result, request_details)
+response_cache = TTLCache(
+    maxsize=config.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=config.RESPONSE_CACHE_TTL_SECONDS
+)
+
+# Disk tier behind response_cache (process-safe, so shared by all workers).
+# Opened in open_disk_cache when serving starts, so importing backend stays cheap
+response_disk_cache = None
+
+
+def response_cache_key(*parts) -> str:
+    """Hash an agent call's inputs (agent, model, system prompt, image hash, user text) into a cache key."""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def _read_disk_cache(cache_key: str) -> tuple[dict, dict] | None:
+    """Read a disk cache entry; entries that no longer unpickle (older schema) are dropped."""
+    try:
+        return response_disk_cache.get(cache_key)
+    except Exception as e:
+        logger.warning("[Cache] Dropping unreadable disk cache entry: %s: %s", type(e).__name__, e)
+        response_disk_cache.delete(cache_key)
+        return None
+
+
+async def get_cached_response(cache_key: str, include_details: bool) -> tuple[dict, dict] | None:
+    """Look up (parsed_result, request_details) in memory, then on disk."""
+    if not config.RESPONSE_CACHE_ENABLED:
+        return None
+    cached = response_cache.get(cache_key)
+    if cached is None and response_disk_cache is not None:
+        cached = await asyncio.to_thread(_read_disk_cache, cache_key)
+        if cached is not None:
+            response_cache[cache_key] = cached
+    # An entry stored without request_details cannot serve a ?debug=1 request; call the API again
+    if cached is not None and include_details and cached[1] is None:
+        return None
+    return cached
+
+
+async def store_cached_response(cache_key: str, parsed_result: dict, request_details: dict) -> None:
+    """Store an agent response in memory and on disk."""
+    if not config.RESPONSE_CACHE_ENABLED:
+        return
+    response_cache[cache_key] = (parsed_result, request_details)
+    if response_disk_cache is not None:
+        await asyncio.to_thread(
+            response_disk_cache.set, cache_key, (parsed_result, request_details),
+            expire=config.RESPONSE_CACHE_TTL_SECONDS
+        )
+
+
+@app.before_serving
+async def open_disk_cache():
+    """Open the shared disk cache for agent responses and run results (creates RESPONSE_DISK_CACHE_DIR)."""
+    global response_disk_cache
+    if config.RESPONSE_DISK_CACHE_DIR:
+        import diskcache
+        response_disk_cache = diskcache.Cache(
+            str(PROJECT_ROOT / config.RESPONSE_DISK_CACHE_DIR),
+            size_limit=config.RESPONSE_DISK_CACHE_SIZE_LIMIT
+        )
+
+
+@app.after_serving
+async def close_disk_cache():
+    """Close the disk cache's SQLite connections on shutdown."""
+    global response_disk_cache
+    if response_disk_cache is not None:
+        response_disk_cache.close()
+    response_disk_cache = None
+
+# Chat completions URL (shown in request_details)
+_CHAT_ENDPOINT = f"{config.GROK_BASE_URL}/chat/completions"
 
+# Shared async clients (created on first use, reused across requests)
+_http_client = None
+_client = None
 
-# Store latest result in memory (no database)
-latest_result = None
+# Concurrency cap and per-minute rate limit shared by all Grok API calls.
+# The config values are server-wide totals; each worker process takes an equal share
+# Worker count: SERVER_WORKERS for `python backend.py` with DEBUG_MODE = False, or
+# for any run that exports SERVER_WORKERS (direct `hypercorn -w N`); else one process
+_WORKER_COUNT = (
+    max(1, config.SERVER_WORKERS)
+    if not config.DEBUG_MODE or os.environ.get("SERVER_WORKERS") else 1
+)
+_api_semaphore = asyncio.Semaphore(max(1, config.GROK_MAX_CONCURRENCY // _WORKER_COUNT))
+_api_rate_limiter = AsyncLimiter(max(1, config.GROK_RPM // _WORKER_COUNT), 60)
 
 
 # =============================================================================
 # API CLIENT & COST CALCULATION
 # =============================================================================
 
-def get_client() -> OpenAI:
-    """Get OpenAI client configured for xAI Grok API."""
-    api_key = os.environ.get("XAI_API_KEY")
-    if not api_key:
-        raise ValueError("XAI_API_KEY environment variable is not set")
-    return OpenAI(base_url=config.GROK_BASE_URL, api_key=api_key)
+def get_client() -> AsyncOpenAI:
+    """Get the shared AsyncOpenAI client configured for xAI Grok API."""
+    global _http_client, _client
+    if _client is None:
+        import httpx
+        from openai import AsyncOpenAI, DefaultAioHttpClient
+        
+        if not _API_KEY:
+            raise ValueError("XAI_API_KEY environment variable is not set")
+        limits = httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY_SECONDS
+        )
+        if config.HTTP_TRANSPORT == "aiohttp":
+            # The default httpx transport stalls under many concurrent requests
+            _http_client = DefaultAioHttpClient(
+                limits=limits,
+                timeout=config.HTTP_TIMEOUT_SECONDS
+            )
+        else:
+            _http_client = httpx.AsyncClient(
+                http2=config.HTTP2_ENABLED,
+                limits=limits,
+                timeout=config.HTTP_TIMEOUT_SECONDS
+            )
+        _client = AsyncOpenAI(
+            base_url=config.GROK_BASE_URL,
+            api_key=_API_KEY,
+            http_client=_http_client,
+            max_retries=0  # create_chat_completion's rate-limited retry is the only retry layer
+        )
+    return _client
+
+
+@app.before_serving
+async def open_client():
+    """Create the shared client once per worker process at startup (fails fast without XAI_API_KEY)."""
+    client = get_client()
+    if config.HTTP_WARM_UP:
+        # Establish a pooled connection now; Agent 1 and the enhancers then reuse it.
+        # Short timeout and no retries: an unreachable API must not stall worker startup
+        try:
+            await client.with_options(
+                timeout=config.HTTP_WARM_UP_TIMEOUT_SECONDS, max_retries=0
+            ).models.list()
+        except Exception as e:
+            logger.warning("[Startup] Connection warm-up failed: %s: %s", type(e).__name__, e)
+
+
+@app.after_serving
+async def close_client():
+    """Close the shared HTTP connection pool on shutdown."""
+    global _http_client, _client
+    if _http_client is not None:
+        await _http_client.aclose()
+    _http_client = None
+    _client = None
+
+
+def _is_retryable_error(exc: BaseException) -> bool:
+    """True for errors the SDK would have retried: 429s, 5xx responses, and connection errors/timeouts."""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    return isinstance(exc, (RateLimitError, InternalServerError, APIConnectionError))
+
+
+@retry(
+    retry=retry_if_exception(_is_retryable_error),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(config.GROK_RATE_LIMIT_MAX_ATTEMPTS),
+    reraise=True
+)
+async def create_chat_completion(
+    client: AsyncOpenAI,
+    consume: Callable[[object], Awaitable] | None = None,
+    **params
+):
+    """
+    Call chat.completions.create within the concurrency/rate limits, retrying on 429, 5xx and connection errors.
+    
+    For stream=True calls pass consume: it is awaited with the stream inside the
+    limits (so the concurrency slot is held until the last chunk), the stream is
+    closed afterwards, and its return value is returned.
+    """
+    async with _api_semaphore, _api_rate_limiter:
+        response = await client.chat.completions.create(**params)
+        if consume is None:
+            return response
+        async with response:  # Close the HTTP response even if consume fails or is cancelled
+            return await consume(response)
 
 
 def get_model_pricing(model: str) -> dict:
@@ -80,142 +312,231 @@ def get_model_pricing(model: str) -> dict:
     }))
 
 
-def calculate_cost(model: str, input_tokens: int, output_tokens: int) -> dict:
+# Per-token USD rates (input, output) from config.MODEL_PRICING, as tuples for one lookup per call
+_PRICING_PER_TOKEN = {
+    model: (pricing["input_per_token"], pricing["output_per_token"])
+    for model, pricing in config.MODEL_PRICING.items()
+}
+_DEFAULT_PRICING_PER_TOKEN = _PRICING_PER_TOKEN.get("_default", (0.20 / 1_000_000, 0.50 / 1_000_000))
+
+
+def calculate_cost(
+    model: str,
+    input_tokens: int,
+    output_tokens: int,
+    include_details: bool = config.RETURN_REQUEST_DETAILS
+) -> dict:
     """Calculate cost for an API call based on token usage."""
-    pricing = get_model_pricing(model)
+    input_rate, output_rate = _PRICING_PER_TOKEN.get(model, _DEFAULT_PRICING_PER_TOKEN)
     
-    input_cost = (input_tokens / 1_000_000) * pricing["input_per_million"]
-    output_cost = (output_tokens / 1_000_000) * pricing["output_per_million"]
+    input_cost = input_tokens * input_rate
+    output_cost = output_tokens * output_rate
     total_cost = input_cost + output_cost
     
-    return {
+    cost_info = {
         "model": model,
         "input_tokens": input_tokens,
         "output_tokens": output_tokens,
         "total_tokens": input_tokens + output_tokens,
         "input_cost_usd": round(input_cost, 6),
         "output_cost_usd": round(output_cost, 6),
-        "total_cost_usd": round(total_cost, 6),
-        "pricing": {
+        "total_cost_usd": round(total_cost, 6)
+    }
+    
+    # Pricing echo is debug information (also available from /config)
+    if include_details:
+        pricing = get_model_pricing(model)
+        cost_info["pricing"] = {
             "input_per_million": pricing["input_per_million"],
             "output_per_million": pricing["output_per_million"],
         }
+    
+    return cost_info
+
+
+def build_cost_total(input_tokens: int, output_tokens: int, total_cost: float) -> dict:
+    """Build the pipeline-wide cost summary (costs["total"]) from accumulated sums."""
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens,
+        "total_cost_usd": round(total_cost, 6)
     }
 
 
+def cached_cost(model: str, include_details: bool = config.RETURN_REQUEST_DETAILS) -> dict:
+    """Cost info for a response served from response_cache (no tokens billed)."""
+    cost_info = calculate_cost(model, 0, 0, include_details)
+    cost_info["cached"] = True
+    return cost_info
+
+
 # =============================================================================
 # AGENT 1: IMAGE ANALYZER
 # =============================================================================
 
-def run_agent1(client: OpenAI, image_base64: str, image_type: str, user_prompt: str) -> tuple[dict, dict, dict]:
+class Agent1Result(msgspec.Struct):
+    """Agent 1 output (schema from agent1_image_extractor.txt; missing fields fall back to gate-safe defaults)."""
+    people_count: int = 0
+    minor_under_16: str = "unclear"
+    nsfw: bool = False
+    description: str = ""
+
+
+# strict=False accepts lenient model output such as "2" for an int or "true" for a bool
+_AGENT1_DECODER = msgspec.json.Decoder(Agent1Result, strict=False)
+
+
+def decode_agent_output(decoder: msgspec.json.Decoder, raw: str):
+    """
+    Decode agent JSON into the decoder's Struct type.
+    
+    Fields with off-schema values (e.g. null, or a string where an int is
+    expected) fall back to their defaults instead of failing the whole run.
+    Invalid JSON still raises.
+    """
+    try:
+        return decoder.decode(raw)
+    except msgspec.ValidationError as e:
+        data = orjson.loads(raw)
+        if not isinstance(data, dict):
+            raise
+        logger.warning("[Decode] Off-schema agent output (%s); invalid fields use defaults", e)
+        result_type = decoder.type
+        valid = {}
+        for name in result_type.__struct_fields__:
+            if name not in data:
+                continue
+            try:
+                msgspec.convert({name: data[name]}, result_type, strict=False)
+            except msgspec.ValidationError:
+                continue
+            valid[name] = data[name]
+        return msgspec.convert(valid, result_type, strict=False)
+
+# Fixed instruction following the user's prompt in the Agent 1 request
+_AGENT1_INSTRUCTION = "\n\nAnalyze the image above and the user's prompt. Provide the JSON output as specified."
+
+# Fixed API parameters for Agent 1 (built once, shared read-only by every call)
+_AGENT1_FMT = {"type": config.AGENT1_RESPONSE_FORMAT}
+_AGENT1_REQUEST_PARAMS = {
+    "model": config.AGENT1_MODEL,
+    "response_format": _AGENT1_FMT,
+    "stream": False  # Routing needs the complete JSON, so Agent 1 is never streamed
+}
+
+def agent1_cache_key(image_hash: bytes, user_prompt: str) -> str:
+    """Key for Agent 1's response cache and the block cache (model, detail, system prompt, inputs)."""
+    return response_cache_key(
+        "agent1", config.AGENT1_MODEL, config.IMAGE_DETAIL, get_agent1_prompt(), image_hash, user_prompt
+    )
+
+
+async def run_agent1(
+    client: AsyncOpenAI,
+    data_url: str,
+    image_type: str,
+    user_prompt: str,
+    cache_key: str,
+    image_preview: str,
+    include_details: bool = config.RETURN_REQUEST_DETAILS
+) -> tuple[Agent1Result, dict, dict]:
     """
     Agent 1: Image Analyzer
     Analyzes the uploaded image AND user prompt to extract: people_count, minor_under_16, nsfw, description.
     Uses vision model (grok-2-vision-1212).
     
     Args:
-        client: OpenAI client
-        image_base64: Base64-encoded image data
+        client: AsyncOpenAI client
+        data_url: Base64 data URL of the image ("data:<type>;base64,...")
         image_type: MIME type of the image
         user_prompt: User's original prompt text (used for NSFW detection in text)
+        cache_key: Response cache key from agent1_cache_key (checked by the caller before encoding)
+        image_preview: Short data URL preview for request_details (base64 truncated)
+        include_details: Build request_details (config.RETURN_REQUEST_DETAILS or ?debug=1)
     
     Returns: (parsed_result, cost_info, request_details)
+    request_details is None unless include_details is set.
     """
-    data_url = f"data:{image_type};base64,{image_base64}"
+    system_prompt = get_agent1_prompt()
     
-    # Include user prompt in the analysis request for proper NSFW routing
-    analysis_request = f"""User's prompt: "{user_prompt}"
-
-Analyze the image above and the user's prompt. Provide the JSON output as specified."""
-    
-    user_content = [
-        {
-            "type": "image_url",
-            "image_url": {
-                "url": data_url,
-                "detail": config.IMAGE_DETAIL
-            }
-        },
-        {
-            "type": "text",
-            "text": analysis_request
+    # The debug copy below only swaps in a short preview for the image URL
+    image_part = {
+        "type": "image_url",
+        "image_url": {
+            "url": data_url,
+            "detail": config.IMAGE_DETAIL
         }
-    ]
-    
-    messages = [
-        {"role": "system", "content": get_agent1_prompt()},
-        {"role": "user", "content": user_content}
-    ]
-    
-    request_params = {
-        "model": config.AGENT1_MODEL,
-        "response_format": {"type": config.AGENT1_RESPONSE_FORMAT},
-        "stream": config.STREAM_RESPONSES
     }
+    # Include user prompt in the analysis request for proper NSFW routing
+    text_part = {
+        "type": "text",
+        "text": f'User\'s prompt: "{user_prompt}"{_AGENT1_INSTRUCTION}'
+    }
+    user_content = [image_part, text_part]
     
-    if config.LOG_API_CALLS:
-        print(f"[Agent 1] Calling {config.AGENT1_MODEL} with image ({image_type}, detail={config.IMAGE_DETAIL})")
+    messages = [system_message(system_prompt), {"role": "user", "content": user_content}]
     
-    response = client.chat.completions.create(
-        model=config.AGENT1_MODEL,
-        messages=messages,
-        response_format={"type": config.AGENT1_RESPONSE_FORMAT},
-        stream=config.STREAM_RESPONSES
+    logger.info(
+        "[Agent 1] Calling %s with image (%s, detail=%s)",
+        config.AGENT1_MODEL, image_type, config.IMAGE_DETAIL
     )
     
+    response = await create_chat_completion(client, messages=messages, **_AGENT1_REQUEST_PARAMS)
+    
     raw_content = response.choices[0].message.content
     
     usage = response.usage
     input_tokens = usage.prompt_tokens if usage else 0
     output_tokens = usage.completion_tokens if usage else 0
     
-    cost_info = calculate_cost(config.AGENT1_MODEL, input_tokens, output_tokens)
+    cost_info = calculate_cost(config.AGENT1_MODEL, input_tokens, output_tokens, include_details)
     
-    if config.LOG_API_CALLS:
-        print(f"[Agent 1] Response: {raw_content}")
-        print(f"[Agent 1] Tokens: {input_tokens} in, {output_tokens} out | Cost: ${cost_info['total_cost_usd']:.6f}")
+    logger.info("[Agent 1] Response: %.*s", config.LOG_MAX_CONTENT_CHARS, raw_content)
+    logger.info(
+        "[Agent 1] Tokens: %d in, %d out | Cost: $%.6f",
+        input_tokens, output_tokens, cost_info["total_cost_usd"]
+    )
     
     # Parse JSON - handle potential markdown code blocks
     json_str = raw_content.strip()
     if json_str.startswith("```"):
-        lines = json_str.split("\n")
-        json_str = "\n".join(lines[1:-1] if lines[-1].strip() == "```" else lines[1:])
-    
-    parsed_result = json.loads(json_str)
-    
-    # Build request details (truncate base64 for readability)
-    truncated_image = f"{image_base64[:50]}...({len(image_base64)} chars total)"
-    request_details = {
-        "request": {
-            "endpoint": f"{config.GROK_BASE_URL}/chat/completions",
-            "parameters": request_params,
-            "messages": [
-                {"role": "system", "content": get_agent1_prompt()},
-                {
-                    "role": "user", 
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{image_type};base64,{truncated_image}",
-                                "detail": config.IMAGE_DETAIL
-                            }
-                        },
-                        {"type": "text", "text": analysis_request}
-                    ]
+        newline = json_str.find("\n")
+        if newline >= 0:
+            json_str = json_str[newline + 1:]
+        if json_str.endswith("```"):
+            json_str = json_str[:-3].rstrip()
+    
+    parsed_result = decode_agent_output(_AGENT1_DECODER, json_str)
+    
+    request_details = None
+    if include_details:
+        # Build request details (reuse sent messages, truncated image preview)
+        redacted_image_part = {
+            "type": "image_url",
+            "image_url": {"url": image_preview, "detail": config.IMAGE_DETAIL}
+        }
+        request_details = {
+            "request": {
+                "endpoint": _CHAT_ENDPOINT,
+                "parameters": _AGENT1_REQUEST_PARAMS,
+                "messages": [
+                    messages[0],
+                    {"role": "user", "content": [redacted_image_part, text_part]}
+                ]
+            },
+            "response": {
+                "raw_content": raw_content,
+                "parsed": parsed_result,
+                "usage": {
+                    "prompt_tokens": input_tokens,
+                    "completion_tokens": output_tokens,
+                    "total_tokens": input_tokens + output_tokens
                 }
-            ]
-        },
-        "response": {
-            "raw_content": raw_content,
-            "parsed": parsed_result,
-            "usage": {
-                "prompt_tokens": input_tokens,
-                "completion_tokens": output_tokens,
-                "total_tokens": input_tokens + output_tokens
             }
         }
-    }
+    
+    await store_cached_response(cache_key, parsed_result, request_details)
     
     return parsed_result, cost_info, request_details
 
@@ -224,7 +545,7 @@ Analyze the image above and the user's prompt. Provide the JSON output as specif
 # ROUTING LOGIC
 # =============================================================================
 
-def determine_route(agent1_result: dict) -> dict:
+def determine_route(agent1_result: Agent1Result) -> dict:
     """
     Determine which agent to use and whether safety gate applies.
     
@@ -242,8 +563,8 @@ def determine_route(agent1_result: dict) -> dict:
         "reason": str
     }
     """
-    nsfw = agent1_result.get("nsfw", False)
-    minor_status = agent1_result.get("minor_under_16", "unclear")
+    nsfw = agent1_result.nsfw
+    minor_status = agent1_result.minor_under_16
     
     if nsfw and config.ROUTE_TO_ADULT_WHEN_NSFW:
         # Adult content requested - safety gate applies
@@ -252,7 +573,7 @@ def determine_route(agent1_result: dict) -> dict:
                 "agent": "blocked",
                 "gate_applied": True,
                 "gate_passed": False,
-                "reason": f"Adult content blocked: minor_under_16='{minor_status}' (requires: {config.GATE_ALLOWED_VALUES})"
+                "reason": f"Adult content blocked: minor_under_16='{minor_status}' (requires: {sorted(config.GATE_ALLOWED_VALUES)})"
             }
         return {
             "agent": "agent3",
@@ -279,7 +600,8 @@ def build_user_message(
     image_description: str,
     people_count: int,
     previous_fragment: dict = None,
-    is_adult: bool = False
+    is_adult: bool = False,
+    fragment_position: str = None
 ) -> str:
     """
     Build the user message for Agent 2 or Agent 3.
@@ -292,6 +614,8 @@ def build_user_message(
         previous_fragment: If provided, includes continuation context
                           {"prompt": "...", "time_range": "0-5 sec"}
         is_adult: If True (Agent 3), include people_count in message
+        fragment_position: For independently generated fragments (CHAIN_FRAGMENTS = False),
+                           e.g. "2 of 2, 5-10 sec", so each fragment asks for its own segment
     
     Returns: Formatted user message string
     """
@@ -318,6 +642,11 @@ User's original prompt:
 Enhanced prompt used: "{previous_fragment['prompt']}"
 
 Generate the continuation for the next 5-second fragment. Advance the action naturally from where the previous fragment ended."""
+    elif fragment_position:
+        message += f"""
+
+--- Fragment {fragment_position} ---
+Generate the prompt for this segment of the video only."""
 
     return message
 
@@ -326,26 +655,58 @@ Generate the continuation for the next 5-second fragment. Advance the action nat
 # AGENT 2 & 3: PROMPT ENHANCERS
 # =============================================================================
 
-def run_prompt_enhancer(
-    client: OpenAI,
+class EnhancerResult(msgspec.Struct):
+    """Agent 2/3 output (schema from the enhancer prompt files)."""
+    prompt: str = ""
+    nsfw: bool = False
+
+
+_ENHANCER_DECODER = msgspec.json.Decoder(EnhancerResult, strict=False)
+
+# Fixed API parameters for Agent 2/3 (built once, shared read-only by every call)
+_JSON_OBJECT_FMT = {"type": "json_object"}
+_ENHANCER_STREAM_PARAMS = (
+    {"stream": True, "stream_options": {"include_usage": True}}  # Usage arrives in the last chunk
+    if config.STREAM_RESPONSES else {"stream": False}
+)
+_AGENT2_REQUEST_PARAMS = {
+    "model": config.AGENT2_MODEL,
+    "response_format": _JSON_OBJECT_FMT,
+    **_ENHANCER_STREAM_PARAMS
+}
+_AGENT3_REQUEST_PARAMS = {
+    "model": config.AGENT3_MODEL,
+    "response_format": _JSON_OBJECT_FMT,
+    **_ENHANCER_STREAM_PARAMS
+}
+
+async def run_prompt_enhancer(
+    client: AsyncOpenAI,
     agent_name: str,
     user_prompt: str,
     image_description: str,
     people_count: int,
-    previous_fragment: dict = None
-) -> tuple[dict, dict, dict]:
+    previous_fragment: dict = None,
+    include_details: bool = config.RETURN_REQUEST_DETAILS,
+    on_delta: Callable[[str], Awaitable[None]] | None = None,
+    fragment_position: str = None
+) -> tuple[EnhancerResult, dict, dict]:
     """
     Run prompt enhancement (Agent 2 or Agent 3).
     
     Args:
-        client: OpenAI client
+        client: AsyncOpenAI client
         agent_name: "agent2" (neutral) or "agent3" (adult)
         user_prompt: Original user prompt
         image_description: From Agent 1
         people_count: From Agent 1
         previous_fragment: For Fragment 2+, contains previous prompt
+        include_details: Build request_details (config.RETURN_REQUEST_DETAILS or ?debug=1)
+        on_delta: Awaited with each content chunk as it streams in (STREAM_RESPONSES only)
+        fragment_position: Segment label for unchained fragments (see build_user_message)
     
     Returns: (parsed_result, cost_info, request_details)
+    request_details is None unless include_details is set.
     """
     # Select appropriate prompt and model
     is_adult = (agent_name == "agent3")
@@ -353,10 +714,12 @@ def run_prompt_enhancer(
     if is_adult:
         system_prompt = get_agent3_prompt()
         model = config.AGENT3_MODEL
+        request_params = _AGENT3_REQUEST_PARAMS
         agent_label = "Agent 3 (Adult)"
     else:
         system_prompt = get_agent2_prompt()
         model = config.AGENT2_MODEL
+        request_params = _AGENT2_REQUEST_PARAMS
         agent_label = "Agent 2 (Neutral)"
     
     # Build user message (with continuation context if Fragment 2+)
@@ -366,67 +729,82 @@ def run_prompt_enhancer(
         image_description, 
         people_count, 
         previous_fragment,
-        is_adult=is_adult
+        is_adult=is_adult,
+        fragment_position=fragment_position
     )
     
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_content}
-    ]
+    cache_key = response_cache_key(agent_name, model, system_prompt, user_content)
+    cached = await get_cached_response(cache_key, include_details)
+    if cached is not None:
+        logger.info("[%s] Cache hit: reusing previous prompt", agent_label)
+        parsed_result, request_details = cached
+        return parsed_result, cached_cost(model, include_details), request_details if include_details else None
     
-    request_params = {
-        "model": model,
-        "response_format": {"type": "json_object"},
-        "stream": config.STREAM_RESPONSES
-    }
+    messages = [system_message(system_prompt), {"role": "user", "content": user_content}]
     
     fragment_info = ""
     if previous_fragment:
         fragment_info = " (Fragment 2 - continuation)"
     
-    if config.LOG_API_CALLS:
-        print(f"[{agent_label}] Calling {model}{fragment_info}")
+    logger.info("[%s] Calling %s%s", agent_label, model, fragment_info)
     
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        response_format={"type": "json_object"},
-        stream=config.STREAM_RESPONSES
-    )
-    
-    raw_content = response.choices[0].message.content
+    if request_params["stream"]:
+        async def read_stream(stream):
+            """Assemble the streamed content, forwarding each chunk as it arrives."""
+            content_parts = []
+            stream_usage = None
+            async for chunk in stream:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        content_parts.append(delta)
+                        if on_delta is not None:
+                            await on_delta(delta)
+                if chunk.usage:
+                    stream_usage = chunk.usage
+            return "".join(content_parts), stream_usage
+        
+        raw_content, usage = await create_chat_completion(
+            client, consume=read_stream, messages=messages, **request_params
+        )
+    else:
+        response = await create_chat_completion(client, messages=messages, **request_params)
+        raw_content = response.choices[0].message.content
+        usage = response.usage
     
-    usage = response.usage
     input_tokens = usage.prompt_tokens if usage else 0
     output_tokens = usage.completion_tokens if usage else 0
     
-    cost_info = calculate_cost(model, input_tokens, output_tokens)
+    cost_info = calculate_cost(model, input_tokens, output_tokens, include_details)
     
-    if config.LOG_API_CALLS:
-        print(f"[{agent_label}] Response: {raw_content}")
-        print(f"[{agent_label}] Tokens: {input_tokens} in, {output_tokens} out | Cost: ${cost_info['total_cost_usd']:.6f}")
+    logger.info("[%s] Response: %.*s", agent_label, config.LOG_MAX_CONTENT_CHARS, raw_content)
+    logger.info(
+        "[%s] Tokens: %d in, %d out | Cost: $%.6f",
+        agent_label, input_tokens, output_tokens, cost_info["total_cost_usd"]
+    )
     
-    parsed_result = json.loads(raw_content)
+    parsed_result = decode_agent_output(_ENHANCER_DECODER, raw_content)
     
-    request_details = {
-        "request": {
-            "endpoint": f"{config.GROK_BASE_URL}/chat/completions",
-            "parameters": request_params,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content}
-            ]
-        },
-        "response": {
-            "raw_content": raw_content,
-            "parsed": parsed_result,
-            "usage": {
-                "prompt_tokens": input_tokens,
-                "completion_tokens": output_tokens,
-                "total_tokens": input_tokens + output_tokens
+    request_details = None
+    if include_details:
+        request_details = {
+            "request": {
+                "endpoint": _CHAT_ENDPOINT,
+                "parameters": request_params,
+                "messages": messages
+            },
+            "response": {
+                "raw_content": raw_content,
+                "parsed": parsed_result,
+                "usage": {
+                    "prompt_tokens": input_tokens,
+                    "completion_tokens": output_tokens,
+                    "total_tokens": input_tokens + output_tokens
+                }
             }
         }
-    }
+    
+    await store_cached_response(cache_key, parsed_result, request_details)
     
     return parsed_result, cost_info, request_details
 
@@ -435,14 +813,330 @@ def run_prompt_enhancer(
 # ROUTES
 # =============================================================================
 
+def dump_json(payload) -> bytes:
+    """Serialize with orjson; msgspec Structs (agent results) are converted to dicts."""
+    return orjson.dumps(payload, default=msgspec.to_builtins)
+
+
+def json_response(payload: dict):
+    """Serialize a (large) response payload with orjson instead of jsonify."""
+    return app.response_class(dump_json(payload), mimetype="application/json")
+
+
+# Disk cache key prefix for run results (agent response keys are bare hex digests)
+_RESULT_KEY_PREFIX = "result:"
+
+
+async def store_result(result: dict) -> bytes:
+    """Serialize a run result once and keep the bytes for /result/<request_id>."""
+    body = dump_json(result)
+    results_cache[result["request_id"]] = body
+    if response_disk_cache is not None:
+        await asyncio.to_thread(
+            response_disk_cache.set, _RESULT_KEY_PREFIX + result["request_id"], body,
+            expire=config.RESULT_CACHE_TTL_SECONDS
+        )
+    return body
+
+
+async def store_result_response(result: dict):
+    """Store a run result and return the same bytes as the JSON response."""
+    return app.response_class(await store_result(result), mimetype="application/json")
+
+
+def image_too_large_response():
+    """413 JSON error for uploads over MAX_IMAGE_SIZE_BYTES."""
+    max_mb = config.MAX_IMAGE_SIZE_BYTES / (1024 * 1024)
+    return jsonify({"error": f"Image too large. Maximum size is {max_mb:.0f} MiB."}), 413
+
+
+@app.errorhandler(413)
+async def request_too_large(error):
+    """Return JSON (not HTML) when Quart rejects a body over MAX_CONTENT_LENGTH."""
+    return image_too_large_response()
+
+
 @app.route("/")
-def serve_index():
+async def serve_index():
     """Serve the frontend HTML."""
-    return send_from_directory(".", "index.html")
+    return await send_from_directory(".", "index.html")
+
+
+async def execute_pipeline(
+    image_data: bytes,
+    content_type: str,
+    user_prompt: str,
+    duration: int,
+    include_details: bool,
+    emit: Callable[[dict], Awaitable[None]] | None = None
+) -> dict:
+    """
+    Run Agent 1, routing and the prompt enhancer(s) on a validated upload.
+    
+    Takes ownership of image_data and releases it once Agent 1 has the image.
+    emit, if given, is awaited with progress events: {"event": "agent1", ...}
+    after routing and {"event": "delta", ...} for each streamed enhancer chunk.
+    
+    Returns the result dict (stored and served by the caller).
+    """
+    image_hash = hashlib.blake2b(image_data, digest_size=16).digest()
+    
+    # A recent safety-gate block for this exact image + prompt is replayed without Agent 1.
+    # Keyed like Agent 1's response cache, so a new model or prompt edit re-asks Agent 1
+    agent1_key = agent1_cache_key(image_hash, user_prompt)
+    cached_block = blocked_cache.get(agent1_key) if config.BLOCK_CACHE_ENABLED else None
+    if cached_block is not None and include_details and cached_block[1] is None:
+        cached_block = None  # Stored without agent1_details; re-run Agent 1 for ?debug=1
+    
+    # Get API client
+    client = get_client()
+    
+    def fragment_delta(fragment_num: int):
+        """on_delta callback forwarding one fragment's streamed tokens to emit."""
+        if emit is None:
+            return None
+        async def on_delta(content: str):
+            await emit({"event": "delta", "fragment_number": fragment_num, "content": content})
+        return on_delta
+    
+    # Initialize cost tracking
+    costs = {
+        "agent1": None,
+        "fragments": [],
+        "total": None
+    }
+    
+    # Calculate number of fragments
+    num_fragments = duration // config.FRAGMENT_LENGTH
+    
+    logger.info(
+        "\n%s\n[Pipeline] Starting: %ds video (%d fragment(s))\n%s",
+        "=" * 60, duration, num_fragments, "=" * 60
+    )
+    
+    # =================================================================
+    # STEP 1: Agent 1 - Image Analysis (includes user prompt for NSFW routing)
+    # =================================================================
+    if cached_block is not None:
+        agent1_result, agent1_details = cached_block
+        if not include_details:
+            agent1_details = None
+        agent1_cost = cached_cost(config.AGENT1_MODEL, include_details)
+        del image_data
+        logger.info("[Agent 1] Block cache hit: replaying previous safety-gate decision")
+    elif (cached_agent1 := await get_cached_response(agent1_key, include_details)) is not None:
+        # Checked here, before the upload is base64-encoded, so a hit skips the encode entirely
+        agent1_result, agent1_details = cached_agent1
+        if not include_details:
+            agent1_details = None
+        agent1_cost = cached_cost(config.AGENT1_MODEL, include_details)
+        del image_data
+        logger.info("[Agent 1] Cache hit: reusing previous analysis")
+    else:
+        # Build the data URL once; drop each intermediate copy as soon as the next exists
+        image_base64 = b64encode(image_data)
+        del image_data
+        data_url_bytes = b"".join((b"data:", content_type.encode("ascii"), b";base64,", image_base64))
+        # Keep only a short preview + length for request_details, not a second full copy
+        image_preview = (
+            f"data:{content_type};base64,{image_base64[:50].decode('ascii')}"
+            f"...({len(image_base64)} chars total)"
+        )
+        del image_base64
+        # The SDK needs a str: decode once here, so only that copy is alive during the API call
+        data_url = data_url_bytes.decode("ascii")
+        del data_url_bytes
+        
+        # Enhancer prompt file I/O runs in a worker thread while Agent 1 is in flight
+        (agent1_result, agent1_cost, agent1_details), _ = await asyncio.gather(
+            run_agent1(
+                client, data_url, content_type, user_prompt, agent1_key, image_preview,
+                include_details=include_details
+            ),
+            asyncio.to_thread(prefetch_enhancer_prompts)
+        )
+        del data_url  # Only Agent 1 needs the image; release it before the enhancer calls
+    
+    costs["agent1"] = agent1_cost
+    # Running totals kept in locals, written to costs["total"] once at the end
+    total_input_tokens = agent1_cost["input_tokens"]
+    total_output_tokens = agent1_cost["output_tokens"]
+    total_cost_usd = agent1_cost["total_cost_usd"]
+    
+    # =================================================================
+    # STEP 2: Routing Decision
+    # =================================================================
+    routing = determine_route(agent1_result)
+    
+    logger.info("[Routing] → %s (%s)", routing["agent"].upper(), routing["reason"])
+    
+    if emit is not None:
+        await emit({"event": "agent1", "agent1_result": agent1_result, "routing": routing})
+    
+    # Build result structure
+    request_id = uuid.uuid4().hex
+    result = {
+        "request_id": request_id,
+        "duration": duration,
+        "num_fragments": num_fragments,
+        "agent1_result": agent1_result,
+        "routing": routing,
+        "fragments": [],
+        "costs": costs if config.TRACK_COSTS else None
+    }
+    if agent1_details is not None:
+        result["agent1_details"] = agent1_details
+    
+    # Check if blocked
+    if routing["agent"] == "blocked":
+        result["blocked"] = True
+        result["blocked_reason"] = routing["reason"]
+        # Only store fresh decisions: re-storing a replayed one would reset its TTL,
+        # so a resubmitted (possibly false) block would never be re-checked by Agent 1
+        if config.BLOCK_CACHE_ENABLED and cached_block is None:
+            blocked_cache[agent1_key] = (agent1_result, agent1_details)
+        costs["total"] = build_cost_total(total_input_tokens, total_output_tokens, total_cost_usd)
+        return result
+    
+    # =================================================================
+    # STEP 3: Generate Fragment(s)
+    # =================================================================
+    agent_name = routing["agent"]
+    image_description = agent1_result.description
+    people_count = agent1_result.people_count
+    
+    time_ranges = [
+        f"{(fragment_num - 1) * config.FRAGMENT_LENGTH}-{fragment_num * config.FRAGMENT_LENGTH} sec"
+        for fragment_num in range(1, num_fragments + 1)
+    ]
+    
+    if config.CHAIN_FRAGMENTS:
+        # Sequential: Fragment 2+ continues from the previous fragment's prompt
+        enhancer_outputs = []
+        previous_fragment = None
+        for fragment_num, time_range in enumerate(time_ranges, start=1):
+            logger.info("\n[Fragment %d] Generating prompt for %s...", fragment_num, time_range)
+            
+            output = await run_prompt_enhancer(
+                client,
+                agent_name,
+                user_prompt,
+                image_description,
+                people_count,
+                previous_fragment,
+                include_details=include_details,
+                on_delta=fragment_delta(fragment_num)
+            )
+            enhancer_outputs.append(output)
+            previous_fragment = {
+                "prompt": output[0].prompt,
+                "time_range": time_range
+            }
+    else:
+        # Concurrent: fragments are enhanced independently (no continuation context).
+        # Each message names its segment, so fragments get distinct prompts and cache keys
+        logger.info("\n[Fragments] Generating %d prompt(s) concurrently...", num_fragments)
+        
+        enhancer_outputs = await asyncio.gather(*(
+            run_prompt_enhancer(
+                client,
+                agent_name,
+                user_prompt,
+                image_description,
+                people_count,
+                include_details=include_details,
+                on_delta=fragment_delta(fragment_num),
+                fragment_position=(
+                    f"{fragment_num} of {num_fragments}, {time_range}" if num_fragments > 1 else None
+                )
+            )
+            for fragment_num, time_range in enumerate(time_ranges, start=1)
+        ))
+    
+    for fragment_num, (time_range, (frag_result, frag_cost, frag_details)) in enumerate(
+        zip(time_ranges, enhancer_outputs), start=1
+    ):
+        # Build fragment info
+        fragment_info = {
+            "fragment_number": fragment_num,
+            "time_range": time_range,
+            "agent_used": agent_name,
+            "result": frag_result,
+            "cost": frag_cost
+        }
+        if frag_details is not None:
+            fragment_info["details"] = frag_details
+        
+        # =========================================================
+        # DEMO MODE NOTE: For Fragment 2+, we're using the SAME
+        # uploaded image. In PRODUCTION, you should use the LAST
+        # FRAME of the previously generated video as the first
+        # frame for this fragment.
+        # =========================================================
+        if fragment_num > 1:
+            fragment_info["_demo_note"] = (
+                "DEMO MODE: Using same uploaded image. "
+                "PRODUCTION: Use last frame of previous video fragment as first frame."
+            )
+            logger.info("[Fragment %d] ⚠️  DEMO: Using same image (production: use last frame of previous video)", fragment_num)
+        
+        result["fragments"].append(fragment_info)
+        
+        # Update costs
+        costs["fragments"].append(frag_cost)
+        total_input_tokens += frag_cost["input_tokens"]
+        total_output_tokens += frag_cost["output_tokens"]
+        total_cost_usd += frag_cost["total_cost_usd"]
+    
+    costs["total"] = build_cost_total(total_input_tokens, total_output_tokens, total_cost_usd)
+    
+    logger.info(
+        "\n%s\n[Pipeline] Complete: $%.6f (%d tokens)\n%s\n",
+        "=" * 60, costs["total"]["total_cost_usd"], costs["total"]["total_tokens"], "=" * 60
+    )
+    
+    return result
+
+
+def describe_pipeline_error(e: Exception) -> str:
+    """Log a pipeline failure and return the error message for the client."""
+    if isinstance(e, msgspec.DecodeError):
+        # Malformed or off-schema model output
+        logger.error("[Pipeline Error] JSON decode failed: %s", e)
+        return f"Failed to parse JSON response: {str(e)}"
+    if isinstance(e, ValueError):
+        logger.error("[Pipeline Error] ValueError: %s", e)
+        return str(e)
+    logger.error("[Pipeline Error] %s: %s", type(e).__name__, e, exc_info=e)
+    return f"Pipeline failed: {type(e).__name__}: {str(e)}"
+
+
+async def ndjson_events(pipeline: Awaitable[dict], events: asyncio.Queue):
+    """
+    Run the pipeline in a task and yield its events as NDJSON lines.
+    
+    The last line is {"event": "result", "result": ...} (also stored for
+    /result/<request_id>) or {"event": "error", "error": ...}.
+    """
+    async def run():
+        try:
+            body = await store_result(await pipeline)
+            await events.put(b'{"event":"result","result":' + body + b"}")
+        except Exception as e:
+            await events.put({"event": "error", "error": describe_pipeline_error(e)})
+        finally:
+            await events.put(None)
+    
+    task = asyncio.create_task(run())
+    try:
+        while (event := await events.get()) is not None:
+            yield (event if isinstance(event, bytes) else dump_json(event)) + b"\n"
+    finally:
+        task.cancel()  # Client disconnected mid-stream: stop paying for the remaining calls
 
 
 @app.route("/run", methods=["POST"])
-def run_pipeline():
+async def run_pipeline():
     """
     Main pipeline endpoint.
     
@@ -452,21 +1146,37 @@ def run_pipeline():
       - 'duration': Video duration in seconds (5 or 10, default: 5)
     
     Returns JSON with:
+      - request_id: Key for fetching this result again via /result/<request_id>
       - agent1_result: Image analysis
       - routing: Which agent was selected and why
       - fragments: Array of enhanced prompts (1 for 5s, 2 for 10s)
       - costs: Token usage and cost breakdown
-    """
-    global latest_result
     
+    With ?stream=1 the response is NDJSON instead: an "agent1" event after
+    routing, "delta" events as enhancer tokens arrive, then the "result" event.
+    """
     try:
+        # Reject oversize uploads from the Content-Length header, before reading the body
+        if request.content_length and request.content_length > config.MAX_REQUEST_SIZE_BYTES:
+            return image_too_large_response()
+        
+        # Chunked uploads carry no Content-Length; Quart enforces MAX_CONTENT_LENGTH while parsing
+        try:
+            files = await request.files
+            form = await request.form
+        except RequestEntityTooLarge:
+            return image_too_large_response()
+        
+        # Request/response traces: on by config, or per request with ?debug=1
+        include_details = config.RETURN_REQUEST_DETAILS or request.args.get("debug") == "1"
+        
         # Validate inputs
-        if "image" not in request.files:
+        if "image" not in files:
             return jsonify({"error": "No image file provided"}), 400
         
-        image_file = request.files["image"]
-        user_prompt = request.form.get("prompt", "").strip()
-        duration = int(request.form.get("duration", config.DEFAULT_DURATION))
+        image_file = files["image"]
+        user_prompt = form.get("prompt", "").strip()
+        duration = int(form.get("duration", config.DEFAULT_DURATION))
         
         if not user_prompt:
             return jsonify({"error": "No prompt provided"}), 400
@@ -478,189 +1188,62 @@ def run_pipeline():
         content_type = image_file.content_type
         if content_type not in config.ALLOWED_IMAGE_TYPES:
             return jsonify({
-                "error": f"Unsupported image type: {content_type}. Allowed: {config.ALLOWED_IMAGE_TYPES}"
+                "error": f"Unsupported image type: {content_type}. Allowed: {sorted(config.ALLOWED_IMAGE_TYPES)}"
             }), 400
         
-        # Read and encode image
-        image_data = image_file.read()
+        if image_file.content_length and image_file.content_length > config.MAX_IMAGE_SIZE_BYTES:
+            return image_too_large_response()
         
+        # The multipart body is already parsed (and capped by MAX_CONTENT_LENGTH) at this
+        # point, so read the part in one go; only the per-image limit is left to check
+        image_data = image_file.read()
         if len(image_data) > config.MAX_IMAGE_SIZE_BYTES:
-            max_mb = config.MAX_IMAGE_SIZE_BYTES / (1024 * 1024)
-            return jsonify({"error": f"Image too large. Maximum size is {max_mb:.0f} MiB."}), 400
-        
-        image_base64 = base64.b64encode(image_data).decode("utf-8")
-        
-        # Get API client
-        client = get_client()
-        
-        # Initialize cost tracking
-        costs = {
-            "agent1": None,
-            "fragments": [],
-            "total": {
-                "input_tokens": 0,
-                "output_tokens": 0,
-                "total_tokens": 0,
-                "total_cost_usd": 0.0
-            }
-        }
-        
-        # Calculate number of fragments
-        num_fragments = duration // config.FRAGMENT_LENGTH
-        
-        if config.LOG_API_CALLS:
-            print(f"\n{'='*60}")
-            print(f"[Pipeline] Starting: {duration}s video ({num_fragments} fragment(s))")
-            print(f"{'='*60}")
-        
-        # =================================================================
-        # STEP 1: Agent 1 - Image Analysis (includes user prompt for NSFW routing)
-        # =================================================================
-        agent1_result, agent1_cost, agent1_details = run_agent1(client, image_base64, content_type, user_prompt)
-        costs["agent1"] = agent1_cost
-        costs["total"]["input_tokens"] += agent1_cost["input_tokens"]
-        costs["total"]["output_tokens"] += agent1_cost["output_tokens"]
-        costs["total"]["total_tokens"] += agent1_cost["total_tokens"]
-        costs["total"]["total_cost_usd"] += agent1_cost["total_cost_usd"]
-        
-        # =================================================================
-        # STEP 2: Routing Decision
-        # =================================================================
-        routing = determine_route(agent1_result)
-        
-        if config.LOG_API_CALLS:
-            print(f"[Routing] → {routing['agent'].upper()} ({routing['reason']})")
-        
-        # Build result structure
-        result = {
-            "duration": duration,
-            "num_fragments": num_fragments,
-            "agent1_result": agent1_result,
-            "agent1_details": agent1_details,
-            "routing": routing,
-            "fragments": [],
-            "costs": costs if config.TRACK_COSTS else None
-        }
-        
-        # Check if blocked
-        if routing["agent"] == "blocked":
-            result["blocked"] = True
-            result["blocked_reason"] = routing["reason"]
-            costs["total"]["total_cost_usd"] = round(costs["total"]["total_cost_usd"], 6)
-            latest_result = result
-            return jsonify(result)
+            return image_too_large_response()
         
-        # =================================================================
-        # STEP 3: Generate Fragment(s)
-        # =================================================================
-        agent_name = routing["agent"]
-        image_description = agent1_result.get("description", "")
-        people_count = agent1_result.get("people_count", 0)
-        
-        for fragment_num in range(1, num_fragments + 1):
-            time_start = (fragment_num - 1) * config.FRAGMENT_LENGTH
-            time_end = fragment_num * config.FRAGMENT_LENGTH
-            time_range = f"{time_start}-{time_end} sec"
-            
-            # For Fragment 2+, include previous fragment's prompt
-            previous_fragment = None
-            if fragment_num > 1 and len(result["fragments"]) > 0:
-                prev = result["fragments"][-1]
-                previous_fragment = {
-                    "prompt": prev["result"]["prompt"],
-                    "time_range": prev["time_range"]
-                }
-            
-            if config.LOG_API_CALLS:
-                print(f"\n[Fragment {fragment_num}] Generating prompt for {time_range}...")
-            
-            # Run prompt enhancer
-            frag_result, frag_cost, frag_details = run_prompt_enhancer(
-                client,
-                agent_name,
-                user_prompt,
-                image_description,
-                people_count,
-                previous_fragment
+        # ?stream=1: NDJSON progress events (routing, enhancer tokens), then the result
+        if request.args.get("stream") == "1":
+            events = asyncio.Queue()
+            pipeline = execute_pipeline(
+                image_data, content_type, user_prompt, duration, include_details, emit=events.put
             )
-            
-            # Build fragment info
-            fragment_info = {
-                "fragment_number": fragment_num,
-                "time_range": time_range,
-                "agent_used": agent_name,
-                "result": frag_result,
-                "details": frag_details,
-                "cost": frag_cost
-            }
-            
-            # =========================================================
-            # DEMO MODE NOTE: For Fragment 2+, we're using the SAME
-            # uploaded image. In PRODUCTION, you should use the LAST
-            # FRAME of the previously generated video as the first
-            # frame for this fragment.
-            # =========================================================
-            if fragment_num > 1:
-                fragment_info["_demo_note"] = (
-                    "DEMO MODE: Using same uploaded image. "
-                    "PRODUCTION: Use last frame of previous video fragment as first frame."
-                )
-                if config.LOG_API_CALLS:
-                    print(f"[Fragment {fragment_num}] ⚠️  DEMO: Using same image (production: use last frame of previous video)")
-            
-            result["fragments"].append(fragment_info)
-            
-            # Update costs
-            costs["fragments"].append(frag_cost)
-            costs["total"]["input_tokens"] += frag_cost["input_tokens"]
-            costs["total"]["output_tokens"] += frag_cost["output_tokens"]
-            costs["total"]["total_tokens"] += frag_cost["total_tokens"]
-            costs["total"]["total_cost_usd"] += frag_cost["total_cost_usd"]
-        
-        # Round total cost
-        costs["total"]["total_cost_usd"] = round(costs["total"]["total_cost_usd"], 6)
+            del image_data  # The pipeline now owns the upload
+            return app.response_class(ndjson_events(pipeline, events), mimetype="application/x-ndjson")
         
-        if config.LOG_API_CALLS:
-            print(f"\n{'='*60}")
-            print(f"[Pipeline] Complete: ${costs['total']['total_cost_usd']:.6f} ({costs['total']['total_tokens']} tokens)")
-            print(f"{'='*60}\n")
+        pipeline = execute_pipeline(image_data, content_type, user_prompt, duration, include_details)
+        del image_data  # The pipeline now owns the upload
+        result = await pipeline
         
-        # Store for /result endpoint
-        latest_result = result
-        
-        return jsonify(result)
-    
-    except ValueError as e:
-        print(f"[Pipeline Error] ValueError: {e}")
-        return jsonify({"error": str(e)}), 500
-    except json.JSONDecodeError as e:
-        print(f"[Pipeline Error] JSON decode failed: {e}")
-        return jsonify({"error": f"Failed to parse JSON response: {str(e)}"}), 500
+        # Store for /result/<request_id> endpoint
+        return await store_result_response(result)
+    
     except Exception as e:
-        import traceback
-        print(f"[Pipeline Error] {type(e).__name__}: {e}")
-        traceback.print_exc()
-        return jsonify({"error": f"Pipeline failed: {type(e).__name__}: {str(e)}"}), 500
+        return jsonify({"error": describe_pipeline_error(e)}), 500
 
 
-@app.route("/result", methods=["GET"])
-def get_result():
-    """Fetch the latest run result."""
-    if latest_result is None:
-        return jsonify({"error": "No results available. Run the pipeline first."}), 404
-    return jsonify(latest_result)
+@app.route("/result/<request_id>", methods=["GET"])
+async def get_result(request_id: str):
+    """Fetch a recent run result by its request_id (from this worker, then the shared disk cache)."""
+    body = results_cache.get(request_id)
+    if body is None and response_disk_cache is not None:
+        body = await asyncio.to_thread(_read_disk_cache, _RESULT_KEY_PREFIX + request_id)
+    if body is None:
+        message = "No result for this request_id (unknown or expired)."
+        if response_disk_cache is None:
+            message += " Without RESPONSE_DISK_CACHE_DIR, results are only kept by the worker that produced them."
+        return jsonify({"error": message}), 404
+    return app.response_class(body, mimetype="application/json")
 
 
 @app.route("/health", methods=["GET"])
-def health_check():
+async def health_check():
     """Health check endpoint."""
     return jsonify({"status": "ok"})
 
 
 @app.route("/config", methods=["GET"])
-def get_config():
+async def get_config():
     """Return current configuration (excluding sensitive data)."""
-    return jsonify({
+    return json_response({
         "grok_base_url": config.GROK_BASE_URL,
         "agent1_model": config.AGENT1_MODEL,
         "agent2_model": config.AGENT2_MODEL,
@@ -670,19 +1253,20 @@ def get_config():
         "default_duration": config.DEFAULT_DURATION,
         "fragment_length": config.FRAGMENT_LENGTH,
         "route_to_adult_when_nsfw": config.ROUTE_TO_ADULT_WHEN_NSFW,
-        "gate_allowed_values": config.GATE_ALLOWED_VALUES,
+        "gate_allowed_values": sorted(config.GATE_ALLOWED_VALUES),  # Sets are not JSON-serializable
         "max_image_size_bytes": config.MAX_IMAGE_SIZE_BYTES,
-        "allowed_image_types": config.ALLOWED_IMAGE_TYPES,
+        "allowed_image_types": sorted(config.ALLOWED_IMAGE_TYPES),
         "log_api_calls": config.LOG_API_CALLS,
+        "return_request_details": config.RETURN_REQUEST_DETAILS,
         "track_costs": config.TRACK_COSTS,
-        "pricing": config.MODEL_PRICING
+        "pricing": {model: dict(pricing) for model, pricing in config.MODEL_PRICING.items()}  # Read-only views -> dicts
     })
 
 
 @app.route("/prompts", methods=["GET"])
-def get_prompts():
+async def get_prompts():
     """Return current system prompts for all agents."""
-    return jsonify({
+    return json_response({
         "agent1": {
             "name": "Image Analyzer",
             "model": config.AGENT1_MODEL,
@@ -705,11 +1289,8 @@ def get_prompts():
 # STARTUP
 # =============================================================================
 
-if __name__ == "__main__":
-    if not os.environ.get("XAI_API_KEY"):
-        print("WARNING: XAI_API_KEY environment variable is not set!")
-        print("Set it in .env file or export XAI_API_KEY='your-api-key-here'")
-    
+def _log_startup():
+    """Print the configuration banner (only when run as a script)."""
     print("=" * 60)
     print("Grok Validator PoC Backend")
     print("=" * 60)
@@ -722,13 +1303,13 @@ if __name__ == "__main__":
     print("-" * 60)
     print("Routing:")
     print(f"  NSFW → Adult: {config.ROUTE_TO_ADULT_WHEN_NSFW}")
-    print(f"  Gate Allows:  {config.GATE_ALLOWED_VALUES}")
+    print(f"  Gate Allows:  {sorted(config.GATE_ALLOWED_VALUES)}")
     print("-" * 60)
     print("Video:")
     print(f"  Durations:   {config.VIDEO_DURATIONS} seconds")
     print(f"  Fragment:    {config.FRAGMENT_LENGTH} seconds each")
     print("-" * 60)
-    print("Prompts (loaded fresh on each request):")
+    print("Prompts (reloaded when the file changes):")
     print(f"  Agent 1:     {config.AGENT1_PROMPT_FILE}")
     print(f"  Agent 2:     {config.AGENT2_PROMPT_FILE}")
     print(f"  Agent 3:     {config.AGENT3_PROMPT_FILE}")
@@ -743,9 +1324,29 @@ if __name__ == "__main__":
     print("   PRODUCTION: Should use last frame of generated video")
     print()
     print("=" * 60)
+
+
+if __name__ == "__main__":
+    if not _API_KEY:
+        print("ERROR: XAI_API_KEY environment variable is not set!")
+        print("Set it in .env file or export XAI_API_KEY='your-api-key-here'")
+        raise SystemExit(1)
     
-    app.run(
-        host=config.SERVER_HOST,
-        port=config.SERVER_PORT,
-        debug=config.DEBUG_MODE
-    )
+    _log_startup()
+    
+    if config.DEBUG_MODE:
+        app.run(
+            host=config.SERVER_HOST,
+            port=config.SERVER_PORT,
+            debug=True
+        )
+    else:
+        # Production: equivalent to `hypercorn backend:app -w N -b HOST:PORT`
+        from hypercorn.config import Config as HypercornConfig
+        from hypercorn.run import run as run_hypercorn
+        
+        hypercorn_config = HypercornConfig()
+        hypercorn_config.application_path = "backend:app"
+        hypercorn_config.bind = [f"{config.SERVER_HOST}:{config.SERVER_PORT}"]
+        hypercorn_config.workers = config.SERVER_WORKERS
+        run_hypercorn(hypercorn_config)
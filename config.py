@@ -5,6 +5,38 @@ All API and application settings in one place.
 Edit this file to customize behavior without touching the main application code.
 """
 
+import os
+import mmap
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+
+from jsonschema import Draft202012Validator
+
+_PROJECT_ROOT = Path(__file__).parent
+
+# Load environment variables from .env file (only if one exists) before any
+# setting below reads os.environ
+if (_PROJECT_ROOT / ".env").exists():
+    from dotenv import load_dotenv
+    load_dotenv(_PROJECT_ROOT / ".env")
+
+_TRUE_VALUES = frozenset(("1", "true", "yes", "on"))
+_FALSE_VALUES = frozenset(("0", "false", "no", "off"))
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    """Read a boolean env var (1/0, true/false, yes/no, on/off); anything else is an error."""
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    value = value.strip().lower()
+    if value in _TRUE_VALUES:
+        return True
+    if value in _FALSE_VALUES:
+        return False
+    raise ValueError(f"{name} must be one of 1/0, true/false, yes/no, on/off (got {value!r})")
+
 # =============================================================================
 # GROK API CONFIGURATION
 # =============================================================================
@@ -42,8 +74,56 @@ IMAGE_DETAIL = "low"
 # Options: "json_object" (ensures valid JSON), "text" (free-form)
 AGENT1_RESPONSE_FORMAT = "json_object"
 
-# Whether to stream responses (False = wait for complete response)
-STREAM_RESPONSES = False
+# Whether to stream Agent 2/3 responses token by token (False = wait for the
+# complete response). Agent 1 always waits: its JSON is needed whole for routing.
+# Streaming also lets POST /run?stream=1 forward prompt tokens as they arrive.
+STREAM_RESPONSES = True
+
+# -----------------------------------------------------------------------------
+# HTTP CONNECTION POOL
+# -----------------------------------------------------------------------------
+# One pooled HTTP client is shared by all requests so TLS handshakes are reused
+
+# HTTP transport for the Grok client
+# Options: "aiohttp" (scales better under many concurrent requests),
+#          "httpx" (default openai-python transport, supports HTTP/2)
+HTTP_TRANSPORT = "aiohttp"
+
+# Use HTTP/2 so Agent 1/2/3 calls multiplex over one connection ("httpx" only)
+HTTP2_ENABLED = True
+
+# Connection pool limits for the shared client
+HTTP_MAX_CONNECTIONS = 200
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 100
+
+# Idle keep-alive connections are kept open this long for reuse (seconds)
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 60
+
+# Request timeout for Grok API calls (seconds)
+HTTP_TIMEOUT_SECONDS = 60
+
+# Open a connection to the API when each worker starts (one GET /models, no
+# tokens billed), so the first /run does not pay the TCP/TLS handshake
+HTTP_WARM_UP = True
+HTTP_WARM_UP_TIMEOUT_SECONDS = 5  # Single attempt; failure is logged, not fatal
+
+# -----------------------------------------------------------------------------
+# RATE LIMITING
+# -----------------------------------------------------------------------------
+# Caps on Grok API calls across all concurrent requests, for the whole server.
+# Each Hypercorn worker enforces its share: the totals divided by SERVER_WORKERS
+# (the full totals for the single-process dev server, unless the SERVER_WORKERS
+# env var is set for a direct Hypercorn run)
+
+# Maximum number of Grok API calls in flight at once
+GROK_MAX_CONCURRENCY = 32
+
+# Maximum Grok API calls started per minute (keep below your xAI RPM limit)
+GROK_RPM = 480
+
+# Attempts per call when Grok responds with a rate-limit error (429), a 5xx, or
+# the connection fails (the SDK's own retries are disabled)
+GROK_RATE_LIMIT_MAX_ATTEMPTS = 5
 
 # =============================================================================
 # CONTENT ROUTING CONFIGURATION
@@ -60,7 +140,8 @@ ROUTE_TO_ADULT_WHEN_NSFW = True
 # Safety gate ONLY applies to adult content (Agent 3)
 # If minor_under_16 is NOT in this list AND nsfw=True, block processing
 # Neutral content (Agent 2) bypasses the safety gate entirely
-GATE_ALLOWED_VALUES = ["no"]
+# (frozenset: membership is checked on every routed request)
+GATE_ALLOWED_VALUES = frozenset(("no",))
 
 # =============================================================================
 # VIDEO DURATION SETTINGS
@@ -75,6 +156,12 @@ DEFAULT_DURATION = 5
 # Fragment length (each fragment is 5 seconds)
 FRAGMENT_LENGTH = 5
 
+# Chain fragments: Fragment 2+ receives the previous fragment's prompt as
+# continuation context, so fragments are generated one after another.
+# Set to False to generate all fragments concurrently (about half the wall time
+# for 10s videos, but Fragment 2 loses its continuation context).
+CHAIN_FRAGMENTS = True
+
 # =============================================================================
 # APPLICATION SETTINGS
 # =============================================================================
@@ -83,18 +170,28 @@ FRAGMENT_LENGTH = 5
 SERVER_HOST = "0.0.0.0"
 SERVER_PORT = 5050
 
-# Flask debug mode (set to False in production)
+# Debug mode: True runs Quart's single-process dev server with reloader,
+# False runs Hypercorn with SERVER_WORKERS processes (set to False in production)
 DEBUG_MODE = True
 
+# Number of Hypercorn worker processes when DEBUG_MODE is False. When starting
+# Hypercorn directly (`hypercorn backend:app -w N`), export SERVER_WORKERS=N as
+# well: each worker reads it to take its share of GROK_RPM / GROK_MAX_CONCURRENCY
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS") or 0) or os.cpu_count() or 1
+
 # Maximum image size in bytes (20 MiB per Grok API docs)
 MAX_IMAGE_SIZE_BYTES = 20 * 1024 * 1024  # 20 MiB
 
-# Allowed image MIME types (per grok_api_readme.txt)
-ALLOWED_IMAGE_TYPES = [
+# Maximum /run request body: the image plus room for the prompt and multipart
+# framing. Larger requests are rejected (413) before the body is read.
+MAX_REQUEST_SIZE_BYTES = MAX_IMAGE_SIZE_BYTES + 64 * 1024
+
+# Allowed image MIME types (per grok_api_readme.txt), checked on every upload
+ALLOWED_IMAGE_TYPES = frozenset((
     "image/jpeg",
     "image/jpg",
     "image/png"
-]
+))
 
 # =============================================================================
 # PROMPT FILE PATHS
@@ -105,50 +202,138 @@ AGENT1_PROMPT_FILE = "prompts/agent1_image_extractor.txt"
 AGENT2_PROMPT_FILE = "prompts/agent2_neutral_enhancer.txt"  # Safe/neutral content
 AGENT3_PROMPT_FILE = "prompts/agent3_adult_enhancer.txt"    # Adult content
 
+
+@lru_cache(maxsize=8)
+def _read_prompt(prompt_path: Path, mtime_ns: int, size: int) -> str:
+    """Read a system prompt via mmap, cached per file version (mtime_ns, size)."""
+    if size == 0:
+        return ""
+    with open(prompt_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return str(mm, "utf-8").strip()
+
+
+def load_prompt(filepath: str) -> str:
+    """Load a prompt file (relative to the project root); re-read only when it changes."""
+    prompt_path = _PROJECT_ROOT / filepath
+    st = os.stat(prompt_path)
+    return _read_prompt(prompt_path, st.st_mtime_ns, st.st_size)
+
+# =============================================================================
+# RESPONSE & RESULT CACHES
+# =============================================================================
+
+# Reuse agent responses for repeated inputs (same image + prompt) instead of
+# calling the API again; cache hits are reported with zero cost
+RESPONSE_CACHE_ENABLED = True
+
+# Maximum number of cached agent responses and how long they stay valid
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+RESPONSE_CACHE_TTL_SECONDS = 3600
+
+# Second, disk-backed tier for the response cache (diskcache), shared by all
+# Hypercorn workers and kept across restarts; /result/<request_id> results are
+# stored here too so any worker can serve them. None keeps both in memory only
+# (per worker, so /result then only works with a single worker)
+RESPONSE_DISK_CACHE_DIR = ".cache/grokvalidator"
+RESPONSE_DISK_CACHE_SIZE_LIMIT = 2 * 1024 ** 3  # 2 GiB
+
+# Remember safety-gate blocks per image + prompt so repeat submissions are
+# rejected without another Agent 1 (vision) call
+BLOCK_CACHE_ENABLED = True
+BLOCK_CACHE_MAX_ENTRIES = 4096
+BLOCK_CACHE_TTL_SECONDS = 24 * 3600
+
+# Recent /run results kept for GET /result/<request_id>
+RESULT_CACHE_MAX_ENTRIES = 256
+RESULT_CACHE_TTL_SECONDS = 600
+
 # =============================================================================
 # LOGGING / DEBUG
 # =============================================================================
 
-# Print API request/response info to console (useful for debugging)
+# Log API request/response info to console (useful for debugging).
+# Sets the "grokvalidator" logger level: INFO when True, WARNING when False
 LOG_API_CALLS = True
 
+# Longest slice of a raw model response written to the log (full text stays
+# in request_details); Agent 2/3 prompts can run to 10+ KB
+LOG_MAX_CONTENT_CHARS = 2048
+
+# Include request/response traces (agent1_details, fragment details) in /run
+# responses for the UI's "View Raw" panels (set to False in production).
+# Overridable via the RETURN_REQUEST_DETAILS env var or .env (1/0, true/false,
+# yes/no, on/off); when off, a single request can still ask for traces with
+# POST /run?debug=1
+RETURN_REQUEST_DETAILS = _env_flag("RETURN_REQUEST_DETAILS", True)
+
 # =============================================================================
 # PRICING (per million tokens, in USD)
 # =============================================================================
 # Source: xAI pricing as of Dec 2024
 # Update these values if pricing changes
 
+# Pricing tiers, shared by every model billed at the same rates
+_STANDARD_TIER = {
+    "input_per_million": 0.20,   # Text + Image input tokens
+    "output_per_million": 0.50,
+}
+_FLAGSHIP_TIER = {
+    "input_per_million": 2.00,
+    "output_per_million": 10.00,
+}
+
 MODEL_PRICING = {
     # grok-2-vision-latest (alias) and grok-2-vision-1212
     # Vision model - used for Agent 1 image analysis
-    "grok-2-vision-latest": {
-        "input_per_million": 0.20,   # Text + Image input tokens
-        "output_per_million": 0.50,
-    },
-    "grok-2-vision-1212": {
-        "input_per_million": 0.20,
-        "output_per_million": 0.50,
-    },
+    "grok-2-vision-latest": _STANDARD_TIER,
+    "grok-2-vision-1212": _STANDARD_TIER,
     
     # grok-4-1-fast-non-reasoning
     # Fast text model without reasoning - used for Agent 2 & 3 prompt enhancement
-    "grok-4-1-fast-non-reasoning": {
-        "input_per_million": 0.20,
-        "output_per_million": 0.50,
-    },
+    "grok-4-1-fast-non-reasoning": _STANDARD_TIER,
     
     # Fallback for other models (grok-4, etc.)
-    "grok-4": {
-        "input_per_million": 2.00,   # Flagship pricing
-        "output_per_million": 10.00,
-    },
+    "grok-4": _FLAGSHIP_TIER,
     
     # Default fallback if model not found
-    "_default": {
-        "input_per_million": 0.20,
-        "output_per_million": 0.50,
+    "_default": _STANDARD_TIER,
+}
+
+# Shape every MODEL_PRICING entry must have; checked once at import so a typo
+# fails at startup instead of silently producing wrong costs
+_PRICING_SCHEMA = {
+    "type": "object",
+    "patternProperties": {
+        ".*": {
+            "type": "object",
+            "required": ["input_per_million", "output_per_million"],
+            "properties": {
+                "input_per_million": {"type": "number", "minimum": 0},
+                "output_per_million": {"type": "number", "minimum": 0},
+            },
+        },
     },
 }
+Draft202012Validator(_PRICING_SCHEMA).validate(MODEL_PRICING)
+
+
+def _freeze_tier(pricing: dict) -> MappingProxyType:
+    """Read-only copy of a pricing tier with per-token rates added."""
+    return MappingProxyType({
+        **pricing,
+        "input_per_token": pricing["input_per_million"] / 1_000_000,
+        "output_per_token": pricing["output_per_million"] / 1_000_000,
+    })
+
+
+# Add per-token rates once at import (cost math is then a single multiply per
+# response) and freeze the table. Frozen tiers are keyed by the original tier
+# object, so models that share a tier also share one read-only copy
+_FROZEN_TIERS = {id(_pricing): _freeze_tier(_pricing) for _pricing in MODEL_PRICING.values()}
+MODEL_PRICING = MappingProxyType({
+    _model: _FROZEN_TIERS[id(_pricing)] for _model, _pricing in MODEL_PRICING.items()
+})
+del _FROZEN_TIERS
 
 # Enable cost tracking in API responses
 TRACK_COSTS = True